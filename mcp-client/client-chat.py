@@ -1,9 +1,11 @@
 import asyncio
 import os
-from openai import OpenAI
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 from contextlib import AsyncExitStack
 
+from ainput import ainput
+
 # 加载 .env 文件，确保 API Key 受到保护
 load_dotenv()
 
@@ -20,27 +22,31 @@ class MCPClient:
         if not self.openai_api_key:
             raise ValueError("❌ 未找到 OpenAI API Key，请在 .env 文件中设置 OPENAI_API_KEY")
 
-        self.client = OpenAI(api_key=self.openai_api_key, base_url=self.base_url)
+        self.client = AsyncOpenAI(api_key=self.openai_api_key, base_url=self.base_url)
 
     async def process_query(self, query: str) -> str:
         """调用 OpenAI API 处理用户查询"""
+        return "".join([delta async for delta in self.stream_query(query)])
+
+    async def stream_query(self, query: str):
+        """调用 OpenAI API 处理用户查询，以流式方式逐段产出回答"""
         messages = [{"role": "system", "content": "你是一个智能助手，帮助用户回答问题。"},
                     {"role": "user", "content": query}]
 
         try:
             # 调用 OpenAI API
-            response = await asyncio.get_event_loop().run_in_executor(
-                None,
-                lambda: self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    max_tokens=1000, # 限制AI生成的最大字数
-                    temperature=0.7, # 控制AI回答的随机性(越高越随机)
-                )
+            stream = await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=1000, # 限制AI生成的最大字数
+                temperature=0.7, # 控制AI回答的随机性(越高越随机)
+                stream=True, # 流式返回，第一段文字生成后即可输出
             )
-            return response.choices[0].message.content
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
         except Exception as e:
-            return f"⚠️ 调用 OpenAI API 时出错: {str(e)}"
+            yield f"⚠️ 调用 OpenAI API 时出错: {str(e)}"
 
     async def chat_loop(self):
         """运行交互式聊天循环"""
@@ -48,12 +54,15 @@ class MCPClient:
 
         while True:
             try:
-                query = input("\n你: ").strip()
+                query = (await ainput("\n你: ")).strip()
                 if query.lower() == 'quit':
                     break
 
-                response = await self.process_query(query)  # 发送用户输入到 OpenAI API
-                print(f"\n🤖 DeepSeek: {response}")
+                # 发送用户输入到 OpenAI API，回答边生成边输出
+                print("\n🤖 DeepSeek: ", end="", flush=True)
+                async for delta in self.stream_query(query):
+                    print(delta, end="", flush=True)
+                print()
 
             except Exception as e:
                 print(f"\n⚠️ 发生错误: {str(e)}")
@@ -61,6 +70,7 @@ class MCPClient:
     async def cleanup(self):
         """清理资源"""
         await self.exit_stack.aclose()
+        await self.client.close()  # 关闭 AsyncOpenAI 的 HTTP 连接池
 
 
 async def main():
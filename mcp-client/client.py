@@ -1,18 +1,26 @@
 import asyncio
 import os
-import json
+import sys
+import orjson
 from typing import Optional
 from contextlib import AsyncExitStack
 
-from openai import OpenAI  
+from openai import AsyncOpenAI  
 from dotenv import load_dotenv
 
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 
+from ainput import ainput
+
 # 加载 .env 文件，确保 API Key 受到保护
 load_dotenv()
 
+def _loads(data):
+    """用 orjson 解析模型返回的工具参数"""
+    return orjson.loads(data)
+
+
 class MCPClient:
     def __init__(self):
         """初始化 MCP 客户端"""
@@ -22,7 +30,8 @@ class MCPClient:
         self.model = os.getenv("MODEL")  # 读取 model
         if not self.openai_api_key:
             raise ValueError("❌ 未找到 OpenAI API Key，请在 .env 文件中设置 OPENAI_API_KEY")
-        self.client = OpenAI(api_key=self.openai_api_key, base_url=self.base_url) # 创建OpenAI client
+        self.client = AsyncOpenAI(api_key=self.openai_api_key, base_url=self.base_url) # 创建OpenAI client
+        self._available_tools: list = []  # 缓存的工具列表（Function Calling 格式），连接时生成一次
         self.session: Optional[ClientSession] = None # 用于保存 MCP 的客户端会话，默认是 None，稍后通过 connect_to_server 进行连接
         self.exit_stack = AsyncExitStack() # 这里两次赋值其实有点冗余（前面已赋值过一次）。不过并不影响功能，等同于覆盖掉前面的对象。可能是手误或调试时多写了一次
 
@@ -47,24 +56,14 @@ class MCPClient:
 
         await self.session.initialize() # 发送初始化消息给服务器，等待服务器就绪
 
-        # 列出 MCP 服务器上的工具
-        response = await self.session.list_tools()
-        tools = response.tools
+        # 列出 MCP 服务器上的工具，并缓存下来供每次查询复用
+        tools = await self.refresh_tools()
         print("\n已连接到服务器，支持以下工具:", [tool.name for tool in tools])     
 
-    # 为什么要两次请求？
-    #   - 第一次：模型根据你的指令，决定要不要用工具
-    #   - 如果需要用工具 → 返回工具名称和参数 → 执行工具 → 把结果作为新的上下文发给模型
-    #   - 第二次：模型基于工具结果给出最终回答
-    async def process_query(self, query: str) -> str:
-        """
-        使用大模型处理查询并调用可用的 MCP 工具 (Function Calling)
-        """
-        messages = [{"role": "user", "content": query}]
-        
+    async def refresh_tools(self):
+        """重新拉取服务器的工具列表并更新缓存（服务器工具发生变化时调用）"""
         response = await self.session.list_tools()
-        
-        available_tools = [{
+        self._available_tools = [{
             "type": "function",
             "function": {
                 "name": tool.name,
@@ -72,13 +71,30 @@ class MCPClient:
                 "input_schema": tool.inputSchema
             }
         } for tool in response.tools]
-        # print(available_tools)
+        return response.tools
+
+    # 为什么要两次请求？
+    #   - 第一次：模型根据你的指令，决定要不要用工具
+    #   - 如果需要用工具 → 返回工具名称和参数 → 执行工具 → 把结果作为新的上下文发给模型
+    #   - 第二次：模型基于工具结果给出最终回答
+    async def process_query(self, query: str) -> str:
+        """
+        使用大模型处理查询并调用可用的 MCP 工具 (Function Calling)，返回完整回答
+        """
+        return "".join([delta async for delta in self.stream_query(query)])
+
+    async def stream_query(self, query: str):
+        """
+        与 process_query 相同，但以流式方式逐段产出最终回答的文本
+        """
+        messages = [{"role": "user", "content": query}]
+        # print(self._available_tools)
 
         # 使用 OpenAI 客户端的方法发送请求
-        response = self.client.chat.completions.create(
+        response = await self.client.chat.completions.create(
             model=self.model,            
             messages=messages,
-            tools=available_tools     
+            tools=self._available_tools     
         )
         
         # 处理返回的内容
@@ -88,7 +104,7 @@ class MCPClient:
             messages.append(content.message.model_dump())
             for tool_call in content.message.tool_calls:
                 tool_name = tool_call.function.name
-                tool_args = json.loads(tool_call.function.arguments)
+                tool_args = _loads(tool_call.function.arguments)
                 # 执行工具
                 result = await self.session.call_tool(tool_name, tool_args)
                 print(f"\n\n[Calling tool {tool_name} with args {tool_args}]\n\n")
@@ -99,14 +115,19 @@ class MCPClient:
                     "content": result.content[0].text,
                     "tool_call_id": tool_call.id,
                 })
-            # 将上面的结果再返回给大模型用于生产最终的结果
-            response = self.client.chat.completions.create(
+            # 将上面的结果再返回给大模型用于生产最终的结果，流式返回，边生成边输出
+            stream = await self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
+                stream=True
             )
-            return response.choices[0].message.content
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+            return
         # 如果没有要调用工具，直接返回 content.message.content（模型的文本回答）
-        return content.message.content
+        if content.message.content:
+            yield content.message.content
     
     async def chat_loop(self):
         """运行交互式聊天循环"""
@@ -114,12 +135,18 @@ class MCPClient:
 
         while True:
             try:
-                query = input("\n你: ").strip()
+                query = (await ainput("\n你: ")).strip()
                 if query.lower() == 'quit':
                     break
                 
-                response = await self.process_query(query)  # 发送用户输入到 OpenAI API
-                print(f"\n🤖 DeepSeekAI: {response}")
+                # 发送用户输入到 OpenAI API，回答边生成边输出；前缀等第一段文字到达再打印，避免和工具调用日志混在一起
+                started = False
+                async for delta in self.stream_query(query):
+                    if not started:
+                        print("\n🤖 DeepSeekAI: ", end="")
+                        started = True
+                    print(delta, end="", flush=True)
+                print()
 
             except Exception as e:
                 print(f"\n⚠️ 发生错误: {str(e)}")
@@ -127,6 +154,7 @@ class MCPClient:
     async def cleanup(self):
         """清理资源"""
         await self.exit_stack.aclose() # 异步地关闭所有在 exit_stack 中注册的资源（包括 MCP 会话）
+        await self.client.close()  # 关闭 AsyncOpenAI 的 HTTP 连接池
 
 async def main():
     server_script_path = sys.argv[1] if len(sys.argv) >= 2 else os.path.join(os.path.dirname(__file__), "server.py")
@@ -138,5 +166,4 @@ async def main():
         await client.cleanup()
 
 if __name__ == "__main__":
-    import sys
     asyncio.run(main())
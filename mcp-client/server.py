@@ -1,45 +1,109 @@
+import asyncio
 import json
+import time
 import httpx
 import os
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from typing import Any
 from mcp.server.fastmcp import FastMCP
 
-# 初始化 MCP 服务器
-mcp = FastMCP("WeatherServer")
-
-
 # 加载 .env 文件，确保 API Key 受到保护
 load_dotenv()
 
 # OpenWeather API 配置
 OPENWEATHER_API_BASE = "https://api.weatherapi.com/v1/current.json" # 请替换为你自己的 OpenWeather API Key
+WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")  # 启动时读取一次，避免每次请求都读环境变量
 USER_AGENT = "weather-app/1.0"
 
+# 天气结果缓存：按规范化后的城市名缓存 5 分钟，重复查询直接命中，不再请求远端
+_WEATHER_CACHE: TTLCache = TTLCache(maxsize=512, ttl=300)
+# 每个城市一把锁，避免冷缓存时同一城市的并发请求同时打到远端；
+# 同时记录持有/等待这把锁的协程数，为 0 时才删除，保证同一城市始终只有一把锁
+_WEATHER_LOCKS: dict[str, asyncio.Lock] = {}
+_WEATHER_WAITERS: dict[str, int] = {}
+
+# 模块级复用的 HTTP 客户端（连接池 + keep-alive），首次使用时再创建
+_HTTP: httpx.AsyncClient | None = None
+
+def get_http() -> httpx.AsyncClient:
+    """
+    获取全局共享的 httpx.AsyncClient，避免每次请求都重新建立 TCP/TLS 连接。
+    :return: 复用的异步 HTTP 客户端
+    """
+    global _HTTP
+    if _HTTP is None or _HTTP.is_closed:
+        _HTTP = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            timeout=httpx.Timeout(30.0),
+            http2=True,
+            headers={"User-Agent": USER_AGENT,
+                     "accept": "application/json"
+                     }
+        )
+    return _HTTP
+
+@asynccontextmanager
+async def lifespan(server: FastMCP):
+    """服务器生命周期：退出时关闭共享的 HTTP 客户端"""
+    global _HTTP
+    try:
+        yield
+    finally:
+        if _HTTP is not None:
+            await _HTTP.aclose()
+            _HTTP = None
+
+# 初始化 MCP 服务器
+mcp = FastMCP("WeatherServer", lifespan=lifespan)
+
 async def fetch_weather(city: str) -> dict[str, Any] | None:
     """
     从 Weather API 获取天气信息。
     :param city: 城市名称（需使用英文，如 Beijing）
     :return: 天气数据字典；若出错返回包含 error 信息的字典
     """
+    key = city.strip().lower()
+    if key in _WEATHER_CACHE:
+        return _WEATHER_CACHE[key]
+
+    lock = _WEATHER_LOCKS.setdefault(key, asyncio.Lock())
+    _WEATHER_WAITERS[key] = _WEATHER_WAITERS.get(key, 0) + 1
+    try:
+        async with lock:
+            # 等锁期间可能已被其他请求填充
+            if key in _WEATHER_CACHE:
+                return _WEATHER_CACHE[key]
+            data = await _request_weather(city)
+            # 错误结果不缓存
+            if "error" not in data:
+                data["_cached_at"] = time.time()
+                _WEATHER_CACHE[key] = data
+            return data
+    finally:
+        # 最后一个使用者离开时删除这把锁，避免锁字典无限增长
+        _WEATHER_WAITERS[key] -= 1
+        if _WEATHER_WAITERS[key] == 0:
+            del _WEATHER_WAITERS[key]
+            del _WEATHER_LOCKS[key]
+
+async def _request_weather(city: str) -> dict[str, Any]:
+    """实际请求 Weather API，不经过缓存"""
     params = {
         "q": city,
-        "key": os.getenv("WEATHER_API_KEY"),
+        "key": WEATHER_API_KEY,
         "lang": "zh"
     }
-    headers = {"User-Agent": USER_AGENT,
-               "accept": "application/json"
-               }
 
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(OPENWEATHER_API_BASE, params=params, headers=headers, timeout=30.0)
-            response.raise_for_status()
-            return response.json()  # 返回字典类型
-        except httpx.HTTPStatusError as e:
-            return {"error": f"HTTP 错误: {e.response.status_code}"}
-        except Exception as e:
-            return {"error": f"请求失败: {str(e)}"}
+    try:
+        response = await get_http().get(OPENWEATHER_API_BASE, params=params)
+        response.raise_for_status()
+        return response.json()  # 返回字典类型
+    except httpx.HTTPStatusError as e:
+        return {"error": f"HTTP 错误: {e.response.status_code}"}
+    except Exception as e:
+        return {"error": f"请求失败: {str(e)}"}
 
 def format_weather(data: dict[str, Any] | str) -> str:
     """
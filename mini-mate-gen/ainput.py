@@ -0,0 +1,30 @@
+import asyncio
+import threading
+
+
+def ainput(prompt: str = "") -> asyncio.Future:
+    """
+    在守护线程中等待 input()，不阻塞事件循环。
+    不用 asyncio.to_thread：默认线程池退出时会等待其中的线程，Ctrl-C 后要按回车程序才能结束。
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def _resolve(setter, value):
+        if not future.done():
+            setter(value)
+
+    def _read():
+        try:
+            line = input(prompt)
+        except Exception as e:  # 如 EOFError
+            setter, value = future.set_exception, e
+        else:
+            setter, value = future.set_result, line
+        try:
+            loop.call_soon_threadsafe(_resolve, setter, value)
+        except RuntimeError:
+            pass  # 事件循环已关闭
+
+    threading.Thread(target=_read, daemon=True).start()
+    return future
@@ -1,17 +1,37 @@
 import asyncio
 import os
+import sys
 import json
-from typing import Optional, Dict
+import orjson
+from typing import Optional, Dict, Callable, Tuple
 from contextlib import AsyncExitStack
+from datetime import timedelta
 
-from openai import OpenAI
+import anyio
+import fastjsonschema
+import tiktoken
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED
+
+from ainput import ainput
 
 load_dotenv()
 
+# 请求还没发出去、连接就已断开时抛出的异常，此时服务器没有收到请求，可以安全重试
+_CONNECTION_ERRORS = (BrokenPipeError, ConnectionResetError, anyio.ClosedResourceError, anyio.BrokenResourceError)
+# 单次工具调用等待响应的上限，服务器卡死时不至于让对话一直挂起
+TOOL_CALL_TIMEOUT = timedelta(seconds=60)
+
+def _loads(data):
+    """解析工具参数 JSON，底层用 orjson（换成 json.loads 即可回退）"""
+    return orjson.loads(data)
+
+
 class MultiServerMCPClient:
     def __init__(self):
         """管理多个 MCP 服务器的客户端"""
@@ -23,30 +43,57 @@ class MultiServerMCPClient:
             raise ValueError("❌ 未找到 OPENAI_API_KEY，请在 .env 文件中配置")
 
         # 初始化 OpenAI Client
-        self.client = OpenAI(api_key=self.openai_api_key, base_url=self.base_url)
+        self.client = AsyncOpenAI(api_key=self.openai_api_key, base_url=self.base_url)
         
         # 存储 (server_name -> MCP ClientSession) 映射
         self.sessions: Dict[str, ClientSession] = {}
         # 存储工具信息
         self.tools_by_session: Dict[str, list] = {}  # 每个 session 的 tools 列表
         self.all_tools = []  # 合并所有工具的列表
+        # 每次请求都发送同一份只读的 tools，保持请求前缀稳定，便于服务端命中前缀缓存
+        self._tools_payload: tuple = ()
+        # 可选：支持显式缓存键的服务端（如 OpenAI 的 prompt_cache_key）通过 PROMPT_CACHE_KEY 开启
+        prompt_cache_key = os.getenv("PROMPT_CACHE_KEY")
+        self._cache_extra_body = {"prompt_cache_key": prompt_cache_key} if prompt_cache_key else None
+        # 工具全名 -> (服务器名, 服务器内的工具名)，连接时建好，调用时直接查表
+        self._tool_route: Dict[str, Tuple[str, str]] = {}
+        self._validators: Dict[str, Callable] = {}  # 每个工具预编译好的参数校验函数
+        # 对话历史按 token 数截断，_history_tokens 与 chat_loop 中的 messages 一一对应
+        self._token_budget = 8000
+        self._history_tokens: list[int] = []
+        self._encoding = None
+        # 每个服务器连接由独立的后台任务持有，关闭时通过对应的 Event 通知它退出
+        self._servers: Dict[str, str] = {}  # server_name -> 脚本路径，重连时使用
+        self._server_tasks: Dict[str, asyncio.Task] = {}
+        self._stop_events: Dict[str, asyncio.Event] = {}
+        self._reconnect_locks: Dict[str, asyncio.Lock] = {}
+        # 定期 ping 各服务器，提前发现断开的连接并在后台重连
+        self._keepalive_interval = 60
+        self._keepalive_task: Optional[asyncio.Task] = None
+        self._reconnect_tasks: set = set()  # 后台重连任务，保留引用以免被回收
+        # 各服务器正在执行的工具调用数；服务器在阻塞执行工具时无法响应 ping，此时不做检查
+        self._in_flight: Dict[str, int] = {}
 
     async def connect_to_servers(self, servers: dict):
         """
         同时启动多个服务器并获取工具
         servers: 形如 {"weather": "weather_server.py", "rag": "rag_server.py"}
         """
-        for server_name, script_path in servers.items():
-            session = await self._start_one_server(script_path)
-            self.sessions[server_name] = session
-            
-            # 列出此服务器的工具
-            resp = await session.list_tools()
+        self._servers.update(servers)
+        # 各服务器的子进程启动和 initialize 握手互不依赖，并发进行
+        await self.ensure_connected()
+        sessions_list = [self.sessions[server_name] for server_name in servers]
+
+        # 并发列出各服务器的工具
+        tool_resps = await asyncio.gather(*[session.list_tools() for session in sessions_list])
+
+        for server_name, resp in zip(servers.keys(), tool_resps):
             self.tools_by_session[server_name] = resp.tools  # 保存到 self.tools_by_session
 
             for tool in resp.tools:
                 # OpenAI Function Calling 格式修正
                 function_name = f"{server_name}_{tool.name}"
+                self._tool_route[function_name] = (server_name, tool.name)
                 # print(tool.name)
                 self.all_tools.append({
                     "type": "function",
@@ -62,6 +109,20 @@ class MultiServerMCPClient:
         self.all_tools = await self.transform_json(self.all_tools)
         # print(self.all_tools)
 
+        # 预编译每个工具的参数 schema，调用时直接复用，避免每次重新解析
+        self._validators = {}
+        for t in self.all_tools:
+            name = t["function"]["name"]
+            try:
+                self._validators[name] = fastjsonschema.compile(t["function"]["parameters"])
+            except fastjsonschema.JsonSchemaDefinitionException as e:
+                # 如 transform_json 去掉了 $defs 后留下无法解析的 $ref；该工具跳过本地校验，不影响其他服务器
+                print(f"\n⚠️  工具 {name} 的参数 schema 无法编译，跳过本地校验: {e}")
+        self._tools_payload = tuple(self.all_tools)
+
+        if self._keepalive_task is None:
+            self._keepalive_task = asyncio.create_task(self._keepalive_loop())
+
         print("\n✅ 已连接到下列服务器:")
         for name in servers:
             print(f"  - {name}: {servers[name]}")
@@ -115,8 +176,66 @@ class MultiServerMCPClient:
     
         return result            
 
-    async def _start_one_server(self, script_path: str) -> ClientSession:
-        """启动单个 MCP 服务器子进程，并返回 ClientSession"""
+    async def ensure_connected(self):
+        """只为尚未连接或已断开的服务器（重新）建立连接，正常的连接保持不动"""
+        missing = [server_name for server_name in self._servers if not self._is_alive(server_name)]
+        if missing:
+            await asyncio.gather(*[self._reconnect(server_name) for server_name in missing])
+
+    def _is_alive(self, server_name: str) -> bool:
+        task = self._server_tasks.get(server_name)
+        return server_name in self.sessions and task is not None and not task.done()
+
+    async def _reconnect(self, server_name: str, stale: Optional[ClientSession] = None) -> ClientSession:
+        """
+        重新连接指定服务器并返回新的 session。
+        stale 为调用方发现已失效的 session；若它已被其他协程替换，直接复用替换后的连接。
+        """
+        lock = self._reconnect_locks.setdefault(server_name, asyncio.Lock())
+        async with lock:
+            current = self.sessions.get(server_name)
+            if current is not None and current is not stale and self._is_alive(server_name):
+                return current
+            self.sessions.pop(server_name, None)
+            await self._stop_server(server_name)
+            session = await self._start_one_server(server_name, self._servers[server_name])
+            self.sessions[server_name] = session
+            return session
+
+    async def _stop_server(self, server_name: str):
+        """通知持有连接的后台任务退出，并等待子进程关闭"""
+        stop = self._stop_events.pop(server_name, None)
+        task = self._server_tasks.pop(server_name, None)
+        if stop is not None:
+            stop.set()
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _keepalive_loop(self):
+        """定期 ping 各服务器，断开的连接在后台替换掉，而不是等到下一次调用工具时才发现"""
+        while True:
+            await asyncio.sleep(self._keepalive_interval)
+            for server_name, session in list(self.sessions.items()):
+                if self._in_flight.get(server_name):
+                    continue
+                try:
+                    await asyncio.wait_for(session.send_ping(), timeout=10)
+                except asyncio.TimeoutError:
+                    # 响应慢只说明服务器忙，不代表连接断开；卡死的调用由 TOOL_CALL_TIMEOUT 兜底
+                    continue
+                except Exception:
+                    try:
+                        await self._reconnect(server_name, stale=session)
+                    except Exception as e:
+                        print(f"\n⚠️  重连服务器 {server_name} 失败: {e}")
+
+    async def _start_one_server(self, server_name: str, script_path: str) -> ClientSession:
+        """
+        启动单个 MCP 服务器子进程，并返回 ClientSession
+
+        stdio_client 内部使用 anyio 的 task group，必须在同一个任务里进入和退出，
+        因此连接放在独立的后台任务中持有，这样多个服务器可以安全地并发启动。
+        """
         is_python = script_path.endswith(".py")
         is_js = script_path.endswith(".js")
         if not (is_python or is_js):
@@ -128,56 +247,116 @@ class MultiServerMCPClient:
             args=[script_path],
             env=None
         )
-        stdio_transport = await self.exit_stack.enter_async_context(stdio_client(server_params))
-        read_stream, write_stream = stdio_transport
-        session = await self.exit_stack.enter_async_context(ClientSession(read_stream, write_stream))
-        await session.initialize()
-        return session
+        ready = asyncio.get_running_loop().create_future()
+        stop = asyncio.Event()
+        self._stop_events[server_name] = stop
+        self._server_tasks[server_name] = asyncio.create_task(self._serve_one_server(server_params, ready, stop))
+        return await ready
 
+    async def _serve_one_server(self, server_params: StdioServerParameters, ready: asyncio.Future, stop: asyncio.Event):
+        """后台任务：建立连接后把 session 交给 ready，并保持连接直到 stop 被设置"""
+        try:
+            async with stdio_client(server_params) as (read_stream, write_stream):
+                async with ClientSession(read_stream, write_stream) as session:
+                    await session.initialize()
+                    ready.set_result(session)
+                    await stop.wait()
+        except Exception as e:
+            if ready.done():
+                raise
+            ready.set_exception(e)
 
-    async def chat_base(self, messages: list) -> list:
-    
-        # messages = [{"role": "user", "content": query}]
-        response = self.client.chat.completions.create(
+
+    async def chat_base(self, messages: list) -> dict:
+        """
+        流式调用模型，回答边生成边输出；模型要求调用工具时执行工具并继续，
+        直到给出最终回答。返回最终的 assistant 消息。
+        """
+        message, finish_reason = await self._stream_chat(messages)
+        while finish_reason == "tool_calls":
+            messages = await self.create_function_response_messages(messages, message)
+            message, finish_reason = await self._stream_chat(messages)
+        return message
+
+    async def _stream_chat(self, messages: list) -> Tuple[dict, Optional[str]]:
+        """
+        以 stream=True 发起一次请求，把文本增量实时写到终端，同时拼出完整的 assistant 消息。
+        :return: (assistant 消息, finish_reason)
+        """
+        stream = await self.client.chat.completions.create(
             model=self.model,
             messages=messages,
-            tools=self.all_tools
+            tools=self._tools_payload,
+            extra_body=self._cache_extra_body,
+            stream=True
         )
-        if response.choices[0].finish_reason == "tool_calls":
-            while True:
-                messages = await self.create_function_response_messages(messages, response)
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    tools=self.all_tools
-                )
-                if response.choices[0].finish_reason != "tool_calls":
-                    break
-                    
-        # return response.choices[0].message.content
-        return response
-        
-    async def create_function_response_messages(self, messages, response):
-        function_call_messages = response.choices[0].message.tool_calls
-        messages.append(response.choices[0].message.model_dump())
+        content_parts = []
+        tool_calls: Dict[int, dict] = {}  # index -> 拼接中的 tool_call
+        finish_reason = None
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            delta = choice.delta
+            if delta.content:
+                if not content_parts:
+                    sys.stdout.write("\nAI: ")
+                sys.stdout.write(delta.content)
+                sys.stdout.flush()
+                content_parts.append(delta.content)
+            # tool_calls 分多个 chunk 到达：id、name 在第一段，arguments 分段拼接
+            for tc in delta.tool_calls or []:
+                call = tool_calls.setdefault(tc.index, {
+                    "id": "",
+                    "type": "function",
+                    "function": {"name": "", "arguments": ""}
+                })
+                if tc.id:
+                    call["id"] = tc.id
+                if tc.function and tc.function.name:
+                    call["function"]["name"] += tc.function.name
+                if tc.function and tc.function.arguments:
+                    call["function"]["arguments"] += tc.function.arguments
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+        if content_parts:
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+
+        message = {"role": "assistant", "content": "".join(content_parts) or None}
+        if tool_calls:
+            message["tool_calls"] = [tool_calls[i] for i in sorted(tool_calls)]
+        return message, finish_reason
         
-        for function_call_message in function_call_messages:
-            tool_name = function_call_message.function.name
-            tool_args = json.loads(function_call_message.function.arguments)
+    async def create_function_response_messages(self, messages, message):
+        function_call_messages = message["tool_calls"]
+        messages.append(message)
         
-            # 运行外部函数
-            function_response = await self._call_mcp_tool(tool_name, tool_args)
+        # 同一轮里模型给出的多个工具调用互不依赖，并发执行
+        results = await asyncio.gather(
+            *[self._call_function(c) for c in function_call_messages],
+            return_exceptions=True
+        )
 
-            # 拼接消息队列
+        # 按原始顺序拼接消息队列，异常转成文本交给模型自行处理
+        for function_call_message, function_response in zip(function_call_messages, results):
+            if isinstance(function_response, BaseException):
+                function_response = f"工具 {function_call_message['function']['name']} 执行出错: {function_response}"
             messages.append(
                 {
                     "role": "tool",
-                    "content": function_response,
-                    "tool_call_id": function_call_message.id,
+                    "content": str(function_response),
+                    "tool_call_id": function_call_message["id"],
                 }
             )
         return messages  
 
+    async def _call_function(self, function_call_message: dict) -> str:
+        """解析单个 tool_call 的参数并运行对应的外部函数"""
+        tool_name = function_call_message["function"]["name"]
+        tool_args = _loads(function_call_message["function"]["arguments"])
+        return await self._call_mcp_tool(tool_name, tool_args)
+
     async def process_query(self, user_query: str) -> str:
         """
         OpenAI 最新 Function Calling 逻辑:
@@ -188,10 +367,11 @@ class MultiServerMCPClient:
         messages = [{"role": "user", "content": user_query}]
 
         # 第一次请求
-        response = self.client.chat.completions.create(
+        response = await self.client.chat.completions.create(
             model=self.model,
             messages=messages,
-            tools=self.all_tools
+            tools=self._tools_payload,
+            extra_body=self._cache_extra_body
         )
         content = response.choices[0]
         print(content)
@@ -202,7 +382,7 @@ class MultiServerMCPClient:
             # 解析 tool_calls
             tool_call = content.message.tool_calls[0]
             tool_name = tool_call.function.name  # 形如 "weather_query_weather"
-            tool_args = json.loads(tool_call.function.arguments)
+            tool_args = _loads(tool_call.function.arguments)
 
             print(f"\n[ 调用工具: {tool_name}, 参数: {tool_args} ]\n")
 
@@ -217,7 +397,7 @@ class MultiServerMCPClient:
                 "tool_call_id": tool_call.id,
             })
             # 第二次请求，让模型整合工具结果，生成最终回答
-            response = self.client.chat.completions.create(
+            response = await self.client.chat.completions.create(
                 model=self.model,
                 messages=messages
             )
@@ -230,43 +410,138 @@ class MultiServerMCPClient:
         """
         根据 "serverName_toolName" 调用相应的服务器工具
         """
-        parts = tool_full_name.split("_", 1)  # 拆分 "weather_query_weather" -> ["weather", "query_weather"]
-        if len(parts) != 2:
+        route = self._tool_route.get(tool_full_name)  # "weather_query_weather" -> ("weather", "query_weather")
+        if not route:
             return f"无效的工具名称: {tool_full_name}"
 
-        server_name, tool_name = parts
+        # 本地校验参数，不合法时直接返回错误，省去一次 MCP 往返
+        validator = self._validators.get(tool_full_name)
+        if validator:
+            try:
+                validator(tool_args)
+            except fastjsonschema.JsonSchemaException as e:
+                return f"工具参数校验失败: {tool_full_name}: {e.message}"
+
+        server_name, tool_name = route
         session = self.sessions.get(server_name)
         if not session:
-            return f"找不到服务器: {server_name}"
-        
-        # 执行 MCP 工具
-        resp = await session.call_tool(tool_name, tool_args)
+            session = await self._reconnect(server_name)
+
+        # 执行 MCP 工具；请求发出前连接已断开时重连一次再试
+        self._in_flight[server_name] = self._in_flight.get(server_name, 0) + 1
+        try:
+            try:
+                resp = await session.call_tool(tool_name, tool_args, read_timeout_seconds=TOOL_CALL_TIMEOUT)
+            except _CONNECTION_ERRORS:
+                session = await self._reconnect(server_name, stale=session)
+                resp = await session.call_tool(tool_name, tool_args, read_timeout_seconds=TOOL_CALL_TIMEOUT)
+        except McpError as e:
+            if e.error.code == CONNECTION_CLOSED:
+                # 服务器可能已经收到并执行了请求（甚至正是这个工具让它退出的），重试会重复执行副作用；
+                # 只在后台换一个新连接，本次错误交给模型处理
+                self._reconnect_in_background(server_name, session)
+            # 超时等错误交给模型处理，而不是中断整个对话
+            return f"工具调用失败: {tool_full_name}: {e.error.message}"
+        finally:
+            self._in_flight[server_name] -= 1
         print(resp)
         return resp.content[0].text if resp.content else "工具执行无输出"
 
+    def _reconnect_in_background(self, server_name: str, stale: ClientSession):
+        """在后台重连服务器，不阻塞当前调用"""
+        async def _run():
+            try:
+                await self._reconnect(server_name, stale=stale)
+            except Exception as e:
+                print(f"\n⚠️  重连服务器 {server_name} 失败: {e}")
+
+        task = asyncio.create_task(_run())
+        self._reconnect_tasks.add(task)
+        task.add_done_callback(self._reconnect_tasks.discard)
+
+    def _count_tokens(self, message: dict) -> int:
+        """估算单条消息占用的 token 数（正文 + 工具调用参数）"""
+        if self._encoding is None:
+            try:
+                try:
+                    self._encoding = tiktoken.encoding_for_model(self.model)
+                except KeyError:
+                    # 非 OpenAI 模型（如 DeepSeek）没有对应编码，用通用编码近似
+                    self._encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                # 编码文件首次使用时需要联网下载，失败时退回按字符数粗略估算
+                self._encoding = False
+        tokens = 4  # 每条消息的角色、分隔符等固定开销
+        if message.get("content"):
+            tokens += self._text_tokens(str(message["content"]))
+        if message.get("tool_calls"):
+            tokens += self._text_tokens(json.dumps(message["tool_calls"], ensure_ascii=False))
+        return tokens
+
+    def _text_tokens(self, text: str) -> int:
+        if self._encoding:
+            return len(self._encoding.encode(text))
+        # 中文约 1 字 1 token，英文约 4 字符 1 token，取折中值
+        return (len(text) + 1) // 2
+
+    def _trim_history(self, messages: list):
+        """
+        原地从最前面删除消息，直到总 token 数不超过预算。
+        assistant 的 tool_calls 消息与其后的 tool 回复一起删除，避免留下孤立的 tool 消息；
+        最后一条消息（当前提问）始终保留。
+        """
+        # 只为新增的消息计算 token 数，已有的直接复用
+        for message in messages[len(self._history_tokens):]:
+            self._history_tokens.append(self._count_tokens(message))
+
+        total = sum(self._history_tokens)
+        while total > self._token_budget and len(messages) > 1:
+            drop = 1
+            if messages[0].get("tool_calls"):
+                while drop < len(messages) and messages[drop].get("role") == "tool":
+                    drop += 1
+            if drop >= len(messages):
+                break
+            total -= sum(self._history_tokens[:drop])
+            del messages[:drop]
+            del self._history_tokens[:drop]
+
+        # 开头不能是失去对应 tool_calls 的 tool 消息
+        while len(messages) > 1 and messages[0].get("role") == "tool":
+            del messages[0]
+            del self._history_tokens[0]
+
     async def chat_loop(self):
         print("\n🤖 多服务器 MCP + 最新 Function Calling 客户端已启动！输入 'quit' 退出。")
         messages = []
+        self._history_tokens = []
 
         while True:
-            query = input("\n你: ").strip()
+            query = (await ainput("\n你: ")).strip()
             if query.lower() == "quit":
                 break
             try:
                 messages.append({"role": "user", "content": query})
-                messages = messages[-20: ]
+                self._trim_history(messages)
                 # print(messages)
-                response = await self.chat_base(messages)
-                messages.append(response.choices[0].message.model_dump())
-                result = response.choices[0].message.content
-                
-                print(f"\nAI: {result}")
+                # 回答在 chat_base 中边生成边输出
+                message = await self.chat_base(messages)
+                messages.append(message)
             except Exception as e:
                 print(f"\n⚠️  调用过程出错: {e}")
 
     async def cleanup(self):
         # 关闭所有资源
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            await asyncio.gather(self._keepalive_task, return_exceptions=True)
+        for task in list(self._reconnect_tasks):
+            task.cancel()
+        await asyncio.gather(*self._reconnect_tasks, return_exceptions=True)
+        await asyncio.gather(*[self._stop_server(server_name) for server_name in list(self._server_tasks)])
+        self.sessions.clear()
         await self.exit_stack.aclose()
+        await self.client.close()  # 关闭 AsyncOpenAI 的 HTTP 连接池
 
 async def main():
     # 服务器脚本
@@ -1,52 +1,162 @@
+import asyncio
 import json
+import os
+import orjson
 from typing import Any
 import csv
 import numpy as np
 import pandas as pd
 import random
 import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from contextlib import redirect_stdout
 from mcp.server.fastmcp import FastMCP
 
+try:
+    import resource  # 仅 Unix 可用，Windows 下不做资源限制
+except ImportError:
+    resource = None
+
 # 初始化 MCP 服务器
 mcp = FastMCP("PythonServer")
 USER_AGENT = "Pythonserver-app/1.0"
 
-@mcp.tool()
-async def python_inter(py_code):
+CPU_LIMIT_SECONDS = 30  # 单次调用可使用的 CPU 时间
+MEMORY_LIMIT_BYTES = 2 * 1024 ** 3  # 每个工作进程可使用的地址空间
+CALL_TIMEOUT_SECONDS = 35  # 单次调用的最长等待时间
+
+# 复用同一个输出缓冲区和重定向上下文，每次调用前清空即可（每个工作进程各一份）
+_BUF = io.StringIO()
+_CTX = redirect_stdout(_BUF)
+
+# 用户代码运行在独立的工作进程中，死循环或大量内存分配不会拖垮服务器本身
+_POOL: ProcessPoolExecutor | None = None
+
+
+def _dumps(obj) -> str:
+    """用 orjson 序列化结果"""
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+def _init_worker():
+    """工作进程启动时设置内存上限（CPU 上限在每次调用时设置）"""
+    if resource is None:
+        return
+    resource.setrlimit(resource.RLIMIT_AS, (MEMORY_LIMIT_BYTES, MEMORY_LIMIT_BYTES))
+
+
+def _limit_cpu_for_call():
     """
-    运行用户提供的 Python 代码，并返回执行结果。
-    
-    :param py_code: 字符串形式的 Python 代码
-    :return: 代码运行的最终结果
+    RLIMIT_CPU 统计的是进程累计的 CPU 时间，工作进程会被长期复用，
+    所以每次调用前把软限制设为「已用时间 + CPU_LIMIT_SECONDS」。
+    """
+    if resource is None:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = int(usage.ru_utime + usage.ru_stime) + 1 + CPU_LIMIT_SECONDS
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _mp_context():
+    """
+    不能用 fork 启动工作进程：stdio 传输的读线程一直持有 stdin 的锁，
+    fork 出的子进程在启动时关闭 sys.stdin 会卡死在这把锁上。
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """获取工作进程池，首次使用时创建"""
+    global _POOL
+    if _POOL is None:
+        _POOL = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=_mp_context(), initializer=_init_worker)
+    return _POOL
+
+
+def _reset_pool(pool: ProcessPoolExecutor, terminate: bool = False):
+    """
+    丢弃指定的进程池，下次调用时重建。
+    :param pool: 出问题的进程池；若它已被替换则只做清理
+    :param terminate: 是否强制结束其工作进程（超时的代码可能在 sleep 或阻塞，不会触发 CPU 限制）
     """
-    g = globals()
-    buf = io.StringIO()
+    global _POOL
+    if _POOL is pool:
+        _POOL = None
+    if terminate:
+        # ProcessPoolExecutor 没有公开的终止接口，直接结束它的工作进程
+        for process in list((pool._processes or {}).values()):
+            process.terminate()
+    pool.shutdown(wait=False, cancel_futures=terminate)
+
+
+def _run_code(py_code: str) -> str:
+    """
+    在工作进程中执行代码，返回 JSON 字符串。
+    每次调用使用独立的命名空间，预置常用模块。
+    """
+    _limit_cpu_for_call()
+    g = {"__builtins__": __builtins__, "json": json, "csv": csv, "np": np, "pd": pd, "random": random, "io": io}
+    buf = _BUF
+    buf.seek(0)
+    buf.truncate(0)
     try:
-        with redirect_stdout(buf):
+        with _CTX:
             result = eval(py_code, g)
-        return json.dumps({"result": str(result), "stdout": buf.getvalue()}, ensure_ascii=False)
+        return _dumps({"result": str(result), "stdout": buf.getvalue()})
     except Exception:
-        global_vars_before = set(g.keys())
+        # 命名空间每次调用都是新建的，只有几个预置名字，直接做集合差即可（按定义顺序输出）
+        vars_before = set(g)
         try:
-            with redirect_stdout(buf):
+            with _CTX:
                 exec(py_code, g)
         except Exception as e:
-            return json.dumps({"error": f"代码执行时报错: {e}", "stdout": buf.getvalue()}, ensure_ascii=False)
-        global_vars_after = set(g.keys())
-        new_vars = global_vars_after - global_vars_before
+            return _dumps({"error": f"代码执行时报错: {e}", "stdout": buf.getvalue()})
+        new_vars = [k for k in g if k not in vars_before]
         if new_vars:
             safe_result = {}
             for var in new_vars:
+                # 不开启 OPT_SERIALIZE_NUMPY：大数组会完整展开，交给 str() 生成截断后的摘要
                 try:
-                    json.dumps(g[var])
+                    _dumps(g[var])
                     safe_result[var] = g[var]
                 except (TypeError, OverflowError):
                     safe_result[var] = str(g[var])
-            return json.dumps({"result": safe_result, "stdout": buf.getvalue()}, ensure_ascii=False)
+            return _dumps({"result": safe_result, "stdout": buf.getvalue()})
         else:
-            return json.dumps({"result": "已经顺利执行代码", "stdout": buf.getvalue()}, ensure_ascii=False)
+            return _dumps({"result": "已经顺利执行代码", "stdout": buf.getvalue()})
+
+@mcp.tool()
+async def python_inter(py_code):
+    """
+    运行用户提供的 Python 代码，并返回执行结果。
+
+    :param py_code: 字符串形式的 Python 代码
+    :return: 代码运行的最终结果
+    """
+    loop = asyncio.get_running_loop()
+    pool = _get_pool()
+    try:
+        return await asyncio.wait_for(
+            loop.run_in_executor(pool, _run_code, py_code),
+            timeout=CALL_TIMEOUT_SECONDS
+        )
+    except asyncio.TimeoutError:
+        # 超时的代码仍占着工作进程，结束整个旧进程池并换一个新的
+        _reset_pool(pool, terminate=True)
+        return _dumps({"error": f"代码执行超时（超过 {CALL_TIMEOUT_SECONDS} 秒）"})
+    except BrokenProcessPool:
+        if pool is not _POOL:
+            # 进程池已因其他调用超时被结束，本次调用被连带中断
+            return _dumps({"error": "代码执行被中断（工作进程因其他调用超时而重启），请重新执行"})
+        _reset_pool(pool)
+        return _dumps({"error": "代码执行进程异常退出（可能超出了 CPU 或内存限制）"})
 
 if __name__ == "__main__":
     # 以标准 I/O 方式运行 MCP 服务器
-    mcp.run(transport='stdio')
\ No newline at end of file
+    mcp.run(transport='stdio')
@@ -1,7 +1,14 @@
-import json
+import orjson
 import httpx
 from typing import Any
+import numpy as np
+import pandas as pd
 import pymysql
+import sqlglot
+from cachetools import TTLCache
+from sqlglot import exp
+from sqlglot.tokens import TokenType
+from dbutils.pooled_db import PooledDB
 import csv
 import os
 from datetime import datetime
@@ -12,6 +19,31 @@ from mcp.server.fastmcp import FastMCP
 mcp = FastMCP("SQLServer")
 USER_AGENT = "SQLserver-app/1.0"
 
+MAX_ROWS = 10000  # sql_inter 单次最多返回的行数
+MAX_EXECUTION_MS = 15000  # sql_inter 单条查询在 MySQL 中的最长执行时间（导出不受限制）
+
+# 查询结果缓存：key 为规范化后的 SQL，同一会话内重复查询直接返回，不再访问数据库
+_SQL_CACHE: TTLCache = TTLCache(maxsize=256, ttl=60)
+
+# MySQL 连接池：复用已建立的连接，避免每次调用工具都重新握手、认证
+POOL = PooledDB(
+    creator=pymysql,
+    mincached=0,  # 启动时不预先建立连接，数据库不可用时服务器仍能正常启动
+    maxcached=8,  # 池中最多保留的空闲连接数
+    maxconnections=16,  # 允许的最大连接数
+    blocking=True,  # 连接用尽时等待而不是报错
+    host='localhost',  # 数据库地址
+    user='root',  # 数据库用户名
+    passwd='root',  # 数据库密码
+    db='plan_dms_ds_20251222',  # 数据库名
+    charset='utf8',  # 字符集选择utf8
+    autocommit=True
+)
+
+def _dumps(obj) -> str:
+    """序列化为 JSON 字符串，NULL 键、numpy 类型等由 orjson 直接处理"""
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode()
+
 def _to_jsonable(value):
     if isinstance(value, Decimal):
         try:
@@ -21,42 +53,153 @@ def _to_jsonable(value):
     if isinstance(value, datetime):
         return value.isoformat()
     try:
-        json.dumps(value)
+        _dumps(value)
         return value
     except Exception:
         return str(value)
 
+# 这些类型的列不需要转换，可以直接序列化
+_PASSTHROUGH_DTYPES = {"integer", "string", "floating", "mixed-integer-float", "boolean", "empty"}
+# 结果行数达到该值时才按列批量转换，行数少时逐个单元格转换反而更快
+_VECTORIZE_MIN_ROWS = 200
+
+def _rows_to_json(rows) -> str:
+    """
+    按列转换查询结果并序列化为 JSON 二维数组，代替逐个单元格调用 _to_jsonable。
+    整数、字符串、浮点列原样交给 orjson（精度不变），Decimal 列整列转 float，
+    其余类型（日期、时间间隔等）仍按 _to_jsonable 的格式逐个转换。
+    :param rows: cursor.fetchall() 的结果
+    :return: JSON 字符串
+    """
+    columns = []
+    for values in zip(*rows):
+        # infer_dtype 由 C 实现，一次判断整列的类型
+        inferred = pd.api.types.infer_dtype(values, skipna=True)
+        if inferred in _PASSTHROUGH_DTYPES:
+            columns.append(values)
+        elif inferred == "decimal":
+            arr = np.array(values, dtype=object)
+            mask = arr != None  # noqa: E711  逐元素比较，找出非 NULL
+            arr[mask] = arr[mask].astype(float)
+            columns.append(arr.tolist())
+        else:
+            columns.append([_to_jsonable(v) for v in values])
+    return _dumps(list(zip(*columns)))
+
+def _check_read_only(statement: exp.Expression):
+    """
+    :raises ValueError: 不是只读查询，或带有加锁子句时
+    """
+    if not isinstance(statement, exp.Query):
+        raise ValueError("只允许执行 SELECT / SHOW / DESCRIBE 等只读查询")
+    if statement.find(exp.Lock):
+        raise ValueError("不允许使用 FOR UPDATE / FOR SHARE / LOCK IN SHARE MODE 等加锁子句")
+
+def _prepare_query(sql_query: str) -> tuple[str, bool, str]:
+    """
+    校验 SQL 只读，并把查询的行数限制在 MAX_ROWS + 1 以内：
+    没有 LIMIT 的加上 LIMIT，LIMIT 过大的改小。
+    :param sql_query: 模型给出的 SQL
+    :return: (实际执行的 SQL, 是否限制了行数, 缓存 key)
+    :raises ValueError: 不是单条只读语句时
+    """
+    try:
+        statements = [s for s in sqlglot.parse(sql_query, read="mysql") if s is not None]
+        tokens = sqlglot.tokenize(sql_query, read="mysql")
+    except sqlglot.errors.SqlglotError as e:
+        raise ValueError(f"SQL 解析失败: {e}")
+    if len(statements) != 1:
+        raise ValueError("一次只能执行一条 SQL 语句")
+
+    statement = statements[0]
+    # 由语法树重新生成 SQL 作为缓存 key，空白、注释、关键字大小写不同的写法会命中同一条缓存
+    cache_key = statement.sql(dialect="mysql", comments=False)
+    if isinstance(statement, exp.Show):
+        return sql_query, False, cache_key
+    if isinstance(statement, exp.Describe):
+        # EXPLAIN ANALYZE 会真正执行其中的语句；其余 EXPLAIN / DESCRIBE 只允许作用于表或只读查询
+        for arg in ("style", "kind"):
+            if "ANALYZE" in str(statement.args.get(arg) or "").upper():
+                raise ValueError("不允许使用 EXPLAIN ANALYZE")
+        target = statement.this
+        if not isinstance(target, exp.Table):
+            _check_read_only(target)
+        return sql_query, False, cache_key
+    _check_read_only(statement)
+    # 多取一行，用来判断结果是否被截断。只改动原始 SQL 中的 LIMIT，
+    # 不执行 sqlglot 重新生成的 SQL，以免改写成当前 MySQL 版本不支持的语法
+    limit = statement.args.get("limit")
+    if limit is not None:
+        count = limit.expression
+        if not (isinstance(count, exp.Literal) and count.is_int):
+            raise ValueError("LIMIT 的行数必须是整数常量")
+        if int(count.this) <= MAX_ROWS + 1:
+            return sql_query, True, cache_key
+        # 最外层的 LIMIT 是最后一个 LIMIT 关键字；行数在其后，或在 "LIMIT offset, n" 的逗号后
+        i = max(i for i, t in enumerate(tokens) if t.token_type == TokenType.LIMIT)
+        count_token = tokens[i + 1]
+        if len(tokens) > i + 3 and tokens[i + 2].token_type == TokenType.COMMA:
+            count_token = tokens[i + 3]
+        if count_token.text != count.this:
+            raise ValueError("无法识别 LIMIT 子句，请去掉 LIMIT 后重试")
+        sql = f"{sql_query[:count_token.start]}{MAX_ROWS + 1}{sql_query[count_token.end + 1:]}"
+        return sql, True, cache_key
+    last = next(t for t in reversed(tokens) if t.token_type != TokenType.SEMICOLON)
+    return f"{sql_query[:last.end + 1]} LIMIT {MAX_ROWS + 1}", True, cache_key
+
+def _envelope(rows_json: str, truncated: bool) -> str:
+    """把已序列化的行数据包进 {"rows": ..., "truncated": ...}，避免再次编码"""
+    return f'{{"rows": {rows_json}, "truncated": {"true" if truncated else "false"}}}'
+
 @mcp.tool()
 async def sql_inter(sql_query):
     """
     查询本地MySQL数据库，通过运行一段SQL代码来进行数据库查询。\
     :param sql_query: 字符串形式的SQL查询语句，用于执行对MySQL中plan_dms_ds_20251222数据库中各张表进行查询，并获得各表中的各类相关信息
-    :return：sql_query在MySQL中的运行结果。
+    :return：sql_query在MySQL中的运行结果，格式为 {"rows": [...], "truncated": 是否因超过行数上限被截断}。
     """
-    
-    connection = pymysql.connect(
-            host='localhost',  # 数据库地址
-            user='root',  # 数据库用户名
-            passwd='root',  # 数据库密码
-            db='plan_dms_ds_20251222',  # 数据库名
-            charset='utf8'  # 字符集选择utf8
-        )
+    try:
+        sql, limited, cache_key = _prepare_query(sql_query)
+    except ValueError as e:
+        return _dumps({"error": str(e)})
+
+    cached = _SQL_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
+    connection = POOL.connection()  # 从连接池取出连接
     
     try:
         with connection.cursor() as cursor:
-            # SQL查询语句
-            sql = sql_query
+            # 连接由两个工具共用，每次取出后按本工具的需要设置查询时限
+            cursor.execute(f"SET SESSION MAX_EXECUTION_TIME={MAX_EXECUTION_MS}")
             cursor.execute(sql)
 
             # 获取查询结果
             results = cursor.fetchall()
-            json_rows = []
-            for row in results:
-                json_rows.append([_to_jsonable(v) for v in row])
-            return json.dumps(json_rows, ensure_ascii=False)
+            truncated = limited and len(results) > MAX_ROWS
+            if truncated:
+                results = results[:MAX_ROWS]
+            rows_json = None
+            if cursor.description and len(results) >= _VECTORIZE_MIN_ROWS:
+                try:
+                    rows_json = _rows_to_json(results)
+                except Exception:
+                    pass
+
+            # 结果行数较少或按列转换失败时，逐个单元格转换
+            if rows_json is None:
+                json_rows = []
+                for row in results:
+                    json_rows.append([_to_jsonable(v) for v in row])
+                rows_json = _dumps(json_rows)
+
+            result = _envelope(rows_json, truncated)
+            _SQL_CACHE[cache_key] = result
+            return result
 
     finally:
-        connection.close()
+        connection.close()  # 归还到连接池，并不真正断开
     
 @mcp.tool()
 async def export_table_to_csv(table_name, output_file):
@@ -66,17 +209,14 @@ async def export_table_to_csv(table_name, output_file):
     :param table_name: 需要导出的表名
     :param output_file: 输出的 CSV 文件路径
     """
-    # 连接 MySQL 数据库
-    connection = pymysql.connect(
-        host='localhost',  # 数据库地址
-        user='root',  # 数据库用户名
-        passwd='root',  # 数据库密码
-        db='plan_dms_ds_20251222',  # 数据库名
-        charset='utf8'  # 字符集
-    )
+    # 从连接池取出 MySQL 连接
+    connection = POOL.connection()
 
     try:
-        with connection.cursor() as cursor:
+        # SSCursor 为流式游标：边从服务器读取边写文件，不会把整张表一次性加载到内存
+        with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+            # 大表导出耗时较长，取消 sql_inter 可能留在该连接上的查询时限
+            cursor.execute("SET SESSION MAX_EXECUTION_TIME=0")
             # 查询数据表的所有数据
             query = f"SELECT * FROM {table_name};"
             cursor.execute(query)
@@ -84,9 +224,6 @@ async def export_table_to_csv(table_name, output_file):
             # 获取所有列名
             column_names = [desc[0] for desc in cursor.description]
 
-            # 获取查询结果
-            rows = cursor.fetchall()
-
             # 确保输出目录存在
             dirpath = os.path.dirname(output_file)
             if dirpath and not os.path.exists(dirpath):
@@ -99,17 +236,23 @@ async def export_table_to_csv(table_name, output_file):
                 # 写入表头
                 writer.writerow(column_names)
                 
-                # 写入数据
-                for row in rows:
-                    writer.writerow([str(_to_jsonable(v)) for v in row])
+                # 逐行读取游标并批量写入数据，同时统计行数
+                rows = 0
+                def _stream_rows():
+                    nonlocal rows
+                    for row in cursor:
+                        rows += 1
+                        yield [str(_to_jsonable(v)) for v in row]
+
+                writer.writerows(_stream_rows())
 
-            return json.dumps({"ok": True, "table": table_name, "rows": len(rows), "file": output_file}, ensure_ascii=False)
+            return _dumps({"ok": True, "table": table_name, "rows": rows, "file": output_file})
 
     except Exception as e:
-        return json.dumps({"ok": False, "error": str(e)}, ensure_ascii=False)
+        return _dumps({"ok": False, "error": str(e)})
 
     finally:
-        connection.close()
+        connection.close()  # 归还到连接池，并不真正断开
 
 if __name__ == "__main__":
     # 以标准 I/O 方式运行 MCP 服务器
@@ -0,0 +1,30 @@
+import asyncio
+import os
+import sys
+
+import orjson
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "python-server.py")
+
+
+async def _call_python_inter(py_code: str) -> dict:
+    """以 stdio 方式启动 python-server.py（即 mcp.run(transport="stdio")），调用一次 python_inter"""
+    server_params = StdioServerParameters(command=sys.executable, args=[SERVER], env=None)
+    async with stdio_client(server_params) as (read_stream, write_stream):
+        async with ClientSession(read_stream, write_stream) as session:
+            await session.initialize()
+            resp = await asyncio.wait_for(session.call_tool("python_inter", {"py_code": py_code}), timeout=30)
+    return orjson.loads(resp.content[0].text)
+
+
+def test_python_inter_over_stdio():
+    # 工作进程若在 stdio 服务器中以 fork 方式启动会卡死，这里会以超时失败
+    result = asyncio.run(_call_python_inter("x = 1\nprint(x)"))
+    assert result == {"result": {"x": 1}, "stdout": "1\n"}
+
+
+def test_python_inter_keeps_names_defined_after_del():
+    result = asyncio.run(_call_python_inter("del json\nr = 1"))
+    assert result["result"] == {"r": 1}
@@ -0,0 +1,35 @@
+import importlib.util
+import os
+
+import pytest
+
+# 文件名带连字符，不能直接 import；连接池不预先建立连接，导入时不需要数据库
+_spec = importlib.util.spec_from_file_location(
+    "sql_server", os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql-server.py")
+)
+sql_server = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(sql_server)
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM t",
+    "SHOW TABLES",
+    "DESCRIBE t",
+    "EXPLAIN SELECT * FROM t WHERE id = 1",
+])
+def test_prepare_query_accepts_read_only(sql):
+    sql_server._prepare_query(sql)
+
+
+@pytest.mark.parametrize("sql", [
+    "DELETE FROM t",
+    "UPDATE t SET a = 1",
+    "SELECT * FROM t FOR UPDATE",
+    "EXPLAIN ANALYZE SELECT * FROM t",
+    "EXPLAIN ANALYZE DELETE t FROM t JOIN u ON t.id = u.id",
+    "EXPLAIN DELETE FROM t",
+    "EXPLAIN SELECT * FROM t FOR UPDATE",
+])
+def test_prepare_query_rejects_writes_and_locks(sql):
+    with pytest.raises(ValueError):
+        sql_server._prepare_query(sql)